@@ -1,17 +1,41 @@
 from fastapi import FastAPI, HTTPException, UploadFile, File, Depends
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 import pandas as pd
-import io
+import pyarrow as pa
+import pyarrow.csv as pac
+import csv
 import uuid
 
 app = FastAPI()
 
 # In-memory storage for users
 users_db: Dict[str, Dict] = {}
+# Index of existing user names for O(1) duplicate checks
+names_db: set[str] = set()
+# Running age sums and counts per first letter, kept in sync with users_db
+group_sum: Dict[str, int] = {}
+group_cnt: Dict[str, int] = {}
+
+# Bytes of CSV parsed per chunk, so large uploads don't load fully into memory
+CSV_BLOCK_SIZE = 4 << 20
+# Largest request body accepted, checked against Content-Length before the body is read
+MAX_UPLOAD_BYTES = 100 << 20
+# Content types clients commonly send for CSV files
+ALLOWED_CSV_TYPES = frozenset(('text/csv', 'application/csv', 'application/vnd.ms-excel'))
+# Columns an uploaded CSV must contain (case-sensitive)
+REQUIRED_COLS = ('Name', 'Age')
+# Only read the required columns, both as strings (empty cells as null); missing ones raise
+CSV_CONVERT_OPTIONS = pac.ConvertOptions(
+    include_columns=list(REQUIRED_COLS),
+    column_types={col: pa.string() for col in REQUIRED_COLS},
+    strings_can_be_null=True,
+)
 
 class User(BaseModel): #BaseModel自動處理驗證、轉換與文件產生
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     name: str
     age: int
 
@@ -19,19 +43,111 @@ class UserCreate(BaseModel):
     name: str
     age: int
 
+class UploadSizeLimitMiddleware:
+    """
+    Reject oversized CSV uploads before FastAPI spools the whole body. Content-Length
+    is checked up front; bodies without it (chunked uploads) are counted as they are
+    received. Other routes pass straight through.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != "/users/upload_csv":
+            await self.app(scope, receive, send)
+            return
+
+        response = None
+        for key, value in scope["headers"]:
+            if key == b"content-length":
+                try:
+                    content_length = int(value)
+                except ValueError:
+                    response = JSONResponse(status_code=400, content={"detail": "Invalid Content-Length header."})
+                else:
+                    if content_length > MAX_UPLOAD_BYTES:
+                        response = JSONResponse(status_code=413, content={"detail": "File too large."})
+                break
+        if response is not None:
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > MAX_UPLOAD_BYTES:
+                    # FastAPI re-raises HTTPException from body parsing, so this becomes the 413
+                    raise HTTPException(status_code=413, detail="File too large.")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware)
+
+def _group_entry(record: Dict) -> Optional[Tuple[str, int]]:
+    """
+    Return the (group, age) a user record contributes to the average-age stats,
+    or None if its name is empty or its age isn't numeric.
+    """
+    name = record.get('name')
+    if not isinstance(name, str) or not name:
+        return None
+    try:
+        age = int(record.get('age'))
+    except (TypeError, ValueError):
+        return None
+    return name[0].upper(), age # Group by first letter, uppercase
+
+def _store_user(record: Dict) -> None:
+    """
+    Add a user record to users_db and update the name index and group stats.
+    """
+    users_db[record['id']] = record
+    names_db.add(record['name'])
+    entry = _group_entry(record)
+    if entry is not None:
+        group, age = entry
+        group_sum[group] = group_sum.get(group, 0) + age
+        group_cnt[group] = group_cnt.get(group, 0) + 1
+
+def _remove_user(user_id: str) -> None:
+    """
+    Remove a user record from users_db and update the name index and group stats.
+    """
+    record = users_db.pop(user_id)
+    names_db.discard(record['name'])
+    entry = _group_entry(record)
+    if entry is not None:
+        group, age = entry
+        group_cnt[group] -= 1
+        if group_cnt[group] == 0:
+            del group_cnt[group]
+            del group_sum[group]
+        else:
+            group_sum[group] -= age
+
 @app.post("/users", response_model=User, status_code=201)
 async def create_user(user_in: UserCreate):
     """
     Create a new user.
     """
-    new_user = User(**user_in.model_dump()) #使用model_dump()將user_in轉成字典型態
-    if any(u['name'] == new_user.name for u in users_db.values()):
-         raise HTTPException(status_code=400, detail=f"User with name '{new_user.name}' already exists")
-    users_db[new_user.id] = new_user.model_dump()
-    return new_user
+    name = user_in.name
+    if name in names_db:
+         raise HTTPException(status_code=400, detail=f"User with name '{name}' already exists")
+    # user_in is already validated, so build the stored record directly
+    user_id = uuid.uuid4().hex
+    record = {"id": user_id, "name": name, "age": user_in.age}
+    _store_user(record)
+    return record
 
-@app.get("/users", response_model=List[User])
-async def get_users():
+# Stored records were validated on insert, so serialize them as plain dicts instead of
+# re-validating through User on every GET; the schema is still documented via responses
+@app.get("/users", responses={200: {"model": List[User]}})
+async def get_users() -> List[Dict]:
     """
     Get a list of all users.
     """
@@ -44,60 +160,128 @@ async def delete_user(user_id: str):
     """
     if user_id not in users_db:
         raise HTTPException(status_code=404, detail="User not found")
-    del users_db[user_id]
+    _remove_user(user_id)
     return None
 
+def _open_csv_reader(f, skipped_names: List[str]) -> Optional[pac.CSVStreamingReader]:
+    """
+    Open a streaming Arrow CSV reader over f that only reads the REQUIRED_COLS columns.
+    Rows with the wrong number of fields are skipped and their names appended to skipped_names.
+    Returns None for a valid header with no data rows.
+    """
+    # Peek at the header so skipped rows can be reported by name
+    header_line = f.readline()
+    header = next(csv.reader([header_line.decode('utf-8-sig', errors='replace')]), [])
+    # Arrow can't infer columns from a lone header without a trailing newline
+    at_eof = not header_line.endswith(b'\n') and not f.read(1)
+    f.seek(0)
+    if at_eof and all(col in header for col in REQUIRED_COLS):
+        return None
+    name_idx = header.index('Name') if 'Name' in header else None
+
+    def skip_invalid_row(row) -> str:
+        fields = next(csv.reader([row.text]), [])
+        if name_idx is not None and name_idx < len(fields) and fields[name_idx]:
+            skipped_names.append(fields[name_idx])
+        else:
+            skipped_names.append('N/A')
+        return 'skip'
+
+    return pac.open_csv(
+        f,
+        read_options=pac.ReadOptions(use_threads=True, block_size=CSV_BLOCK_SIZE),
+        parse_options=pac.ParseOptions(invalid_row_handler=skip_invalid_row),
+        convert_options=CSV_CONVERT_OPTIONS,
+    )
+
+def _next_csv_chunk(reader: pac.CSVStreamingReader) -> Optional[pd.DataFrame]:
+    """
+    Read the next record batch from reader as a DataFrame, or None when exhausted.
+    """
+    batch = next(reader, None)
+    return None if batch is None else batch.to_pandas()
+
+def _add_users_from_chunk(df: pd.DataFrame, skipped_names: List[str]) -> int:
+    """
+    Insert the valid, non-duplicate rows of a CSV chunk and return how many were added.
+    Names of skipped rows are appended to skipped_names.
+    """
+    df = df.rename(columns={'Name': 'name', 'Age': 'age'})
+    # Coerce ages to numbers; rows with a missing name or an age that is non-numeric
+    # or doesn't fit in int64 are skipped (NaN fails both range comparisons)
+    df['age'] = pd.to_numeric(df['age'], errors='coerce')
+    in_range = (df['age'] >= -2**63) & (df['age'] < 2**63)
+    bad = df['name'].isna() | ~in_range
+    skipped_names.extend(df.loc[bad, 'name'].fillna('N/A').astype(str).tolist())
+    df = df.loc[~bad].astype({'name': str, 'age': 'int64'})
+
+    # Skip names that already exist (names_db already holds earlier chunks),
+    # including repeats within this chunk
+    # Probe the set row by row: isin() would copy all of names_db on every chunk
+    dup_mask = df['name'].map(names_db.__contains__).astype(bool) | df['name'].duplicated()
+    skipped_names.extend(df.loc[dup_mask, 'name'].tolist())
+
+    # Pull each column out as a list of native Python values in one call, rather
+    # than building an intermediate dict per row
+    df = df.loc[~dup_mask]
+    names = df['name'].tolist()
+    ages = df['age'].tolist()
+    for name, age in zip(names, ages):
+        new_id = uuid.uuid4().hex
+        _store_user({"id": new_id, "name": name, "age": age})
+    return len(names)
+
 @app.post("/users/upload_csv", status_code=201)
 async def upload_users_csv(file: UploadFile = File(...)):
     """
     Add multiple users from an uploaded CSV file.
     The CSV file must have 'name' and 'age' columns.
     """
-    if file.content_type != 'text/csv':
+    if file.content_type not in ALLOWED_CSV_TYPES:
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload a CSV file.")
 
-    contents = await file.read()
+    added_count = 0
+    skipped_names = []
+
+    # Parse the spooled upload in chunks with Arrow's multithreaded CSV reader.
+    # Parsing runs in a worker thread so it doesn't block the event loop; inserting
+    # stays on the loop so users_db is only ever mutated from one thread.
     try:
-        # Use StringIO to treat the byte string as a file
-        df = pd.read_csv(io.StringIO(contents.decode('utf-8')))
+        reader = await run_in_threadpool(_open_csv_reader, file.file, skipped_names)
+    except pa.ArrowKeyError:
+        # Raised by include_columns when the expected columns are missing (case-sensitive)
+        raise HTTPException(status_code=400, detail="CSV must contain 'Name' and 'Age' columns.")
     except Exception as e:
          raise HTTPException(status_code=400, detail=f"Error processing CSV file: {e}")
 
-    # Expect 'Name' and 'Age' columns (case-sensitive)
-    if not {'Name', 'Age'}.issubset(df.columns):
-        raise HTTPException(status_code=400, detail="CSV must contain 'Name' and 'Age' columns.")
+    error = None
+    # reader is None when the file is just a header, so there is nothing to add
+    if reader is not None:
+        with reader:
+            while True:
+                try:
+                    chunk = await run_in_threadpool(_next_csv_chunk, reader)
+                except Exception as e:
+                    if added_count == 0:
+                        raise HTTPException(status_code=400, detail=f"Error processing CSV file: {e}")
+                    # Earlier chunks are already stored, so report them alongside the error
+                    error = f"Error processing CSV file: {e}"
+                    break
+                if chunk is None:
+                    break
+                added_count += _add_users_from_chunk(chunk, skipped_names)
 
-    added_count = 0
-    skipped_count = 0
-    skipped_names = []
+    skipped_count = len(skipped_names)
 
-    for _, row in df.iterrows():
-        try:
-            # Use 'Name' and 'Age' from the CSV row
-            user_data = UserCreate(name=row['Name'], age=int(row['Age']))
-            # Check if user already exists by name before adding
-            if any(u['name'] == user_data.name for u in users_db.values()):
-                skipped_count += 1
-                skipped_names.append(user_data.name)
-                continue
-
-            new_user = User(**user_data.model_dump())
-            users_db[new_user.id] = new_user.model_dump()
-            added_count += 1
-        except Exception as e:
-            # Handle potential data validation errors or other issues per row
-            print(f"Skipping row due to error: {row} - {e}") # Log error for debugging
-            skipped_count += 1
-            # Use 'Name' for skipped names if available
-            skipped_names.append(str(row.get('Name', 'N/A')))
-
-
-    return {
-        "message": f"Processed CSV file.",
+    result = {
+        "message": f"Processed CSV file." if error is None else "Partially processed CSV file.",
         "added_users": added_count,
         "skipped_users": skipped_count,
         "skipped_names": skipped_names
     }
+    if error is not None:
+        result["error"] = error
+    return result
 
 
 @app.get("/users/average_age")
@@ -108,20 +292,15 @@ async def get_average_age_by_group():
     if not users_db:
         return {"message": "No users available to calculate average age."}
 
-    users_list = list(users_db.values())
-    df = pd.DataFrame(users_list)
-
-    # Ensure 'name' is string and handle potential errors
-    df['name'] = df['name'].astype(str)
-    df['group'] = df['name'].str[0].str.upper() # Group by first letter, uppercase
-
-    # Ensure 'age' is numeric, coercing errors to NaN which will be ignored by mean()
-    df['age'] = pd.to_numeric(df['age'], errors='coerce')
-
-    # Calculate average age, dropping groups where age might be NaN after coercion
-    average_ages = df.dropna(subset=['age']).groupby('group')['age'].mean().round(2).to_dict()
-
-    return average_ages
+    # Stats are maintained on every insert/delete, so no scan over users_db is needed
+    return {group: round(group_sum[group] / group_cnt[group], 2) for group in group_sum}
 
 # To run the app (save this as main.py and run uvicorn main:app --reload)
 # Example: uvicorn fastapi_user_app.main:app --reload
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvloop and httptools (from uvicorn[standard]) provide a C event loop and HTTP parser.
+    # users_db lives in process memory, so this runs a single worker by default;
+    # set WEB_CONCURRENCY to use more (each worker then has its own users).
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, loop="uvloop", http="httptools")